@@ -1,56 +1,153 @@
-import os
 import json
+import time
 import logging
+import threading
+from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
 import billboard
 
-YOUTUBE_API = 'https://www.googleapis.com/youtube/v3/search'
-YOUTUBE_LINK_PREFIX = 'https://www.youtube.com/watch?v='
-YOUTUBE_SEARCH_PREFIX = 'https://www.youtube.com/results?search_query='
+from JsonStore import MemoryJsonStore
+from Storage import log_store_result
+from Database import get_month_day, get_year
+from Profiling import profiled, stage
+from YouTube import YouTube, YOUTUBE_SEARCH_PREFIX, is_video
+
+CHART_CACHE_KEY = 'Billboard-charts/{}/{}.json'
+# Names used in event titles, which must stay stable because rows are matched by title
+CHART_TITLES = {
+    'hot-100': 'Hot 100',
+    'billboard-200': '200'
+}
+# Charts that rank albums rather than songs
+ALBUM_CHARTS = ['billboard-200']
+
+
+def get_current_chart_date(today=None):
+    # A chart is revealed on Tuesday and dated the Saturday of the same week
+    today = today or date.today()
+    return today - timedelta(days=(today.weekday() - 1) % 7) + timedelta(days=4)
+
+
+def get_chart_dates(start_date, end_date):
+    # Charts are dated on Saturdays, and Billboard rounds any other date up to the next one
+    if start_date is None:
+        return [None]
+    cursor = start_date + timedelta(days=(5 - start_date.weekday()) % 7)
+    result = []
+    while cursor <= end_date:
+        result.append(cursor.strftime('%Y-%m-%d'))
+        cursor = cursor + timedelta(days=7)
+    return result
+
+
+class PoliteLimiter(object):
+    # At most max_concurrent requests in flight, started at least min_interval seconds apart
+    def __init__(self, max_concurrent=2, min_interval=1.0):
+        self.semaphore = threading.BoundedSemaphore(max_concurrent)
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.last_start = 0
+
+    def __enter__(self):
+        self.semaphore.acquire()
+        with self.lock:
+            wait = self.last_start + self.min_interval - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            self.last_start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.semaphore.release()
 
 
 class Billboard(object):
-    def __init__(self):
-        self.chart = billboard.ChartData('hot-100')
+    def __init__(self, chart_names=None, start_date=None, end_date=None, youtube=None,
+                 chart_store=None, max_workers=4, limiter=None):
         self.label_name = 'Billboard'
-        self.target_date = self.chart.date
         self.logger = logging.getLogger(
             'daily_collector.{}'.format(self.__class__.__name__))
-        self.events = [self.chart[0]]
-        self.multimedia_link_memo = {}
+        self.chart_names = chart_names or ['hot-100']
+        # Past charts never change, so every (chart, date) is fetched from billboard.com once
+        self.chart_store = chart_store or MemoryJsonStore()
+        self.limiter = limiter or PoliteLimiter()
+        self.youtube = youtube or YouTube()
+        chart_requests = [(name, chart_date) for chart_date in get_chart_dates(start_date, end_date or date.today())
+                          for name in self.chart_names]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            charts = list(executor.map(
+                lambda r: self.get_chart(*r), chart_requests))
+        self.charts = [chart for chart in charts if chart]
+        self.events = self.get_number_ones(self.charts)
+        self.target_date = max([e['date'] for e in self.events]) if self.events else str(
+            end_date or date.today())
+
+    def get_chart(self, name, chart_date):
+        # The latest chart is looked up by the date it is expected to have, so it is fetched once a week
+        cached = self.chart_store.load(CHART_CACHE_KEY.format(
+            name, chart_date or get_current_chart_date().strftime('%Y-%m-%d')))
+        if cached:
+            return cached
+        try:
+            with self.limiter:
+                self.logger.info('Fetching {} chart of {} ...'.format(
+                    name, chart_date or 'this week'))
+                chart = billboard.ChartData(name, date=chart_date)
+        except Exception as exception:
+            self.logger.error('Could not fetch {} chart of {}: {}'.format(
+                name, chart_date, type(exception).__name__))
+            return None
+        if len(chart) < 1:
+            self.logger.warn('{} chart of {} has no entries'.format(
+                name, chart_date))
+            return None
+        result = json.loads(chart.json())
+        # Published charts never change, including the latest one dated a few days ahead
+        if chart.date:
+            self.chart_store.save(CHART_CACHE_KEY.format(
+                name, chart.date), result)
+        return result
+
+    def get_number_ones(self, charts):
+        # The same song often tops several charts in the same week, and only needs to be looked up once
+        result = {}
+        for chart in charts:
+            top = chart['entries'][0]
+            key = (str(chart['date']), self.get_chart_kind(chart['name']),
+                   top['title'].lower(), top['artist'].lower())
+            if key not in result:
+                result[key] = {
+                    'date': str(chart['date']),
+                    'title': top['title'],
+                    'artist': top['artist'],
+                    'weeks': top['weeks'],
+                    'charts': []
+                }
+            result[key]['charts'].append(chart['name'])
+            result[key]['weeks'] = max(result[key]['weeks'], top['weeks'])
+        # Keep the order of chart_names, so a song on several charts is titled after the first one
+        for event in result.values():
+            event['charts'].sort(key=self.chart_names.index)
+        return sorted(result.values(), key=lambda e: (e['date'], e['title']))
+
+    def get_chart_title(self, name):
+        return CHART_TITLES.get(name, name.replace('-', ' ').title())
+
+    def get_chart_kind(self, name):
+        return 'Album' if name in ALBUM_CHARTS else 'Song'
 
     def get_query(self, title, artist):
         raw = title + '+' + artist
         return raw.replace(' ', '+')
 
     def get_media_link(self, title, artist):
-        query = self.get_query(title, artist)
-        if query in self.multimedia_link_memo:
-            return self.multimedia_link_memo[query]
-        payload = {
-            'q': query,
-            'maxResult': 5,
-            'key': os.environ['YOUTUBE_API_KEY'],
-            'part': 'snippet'
-        }
-        items = requests.get(YOUTUBE_API, params=payload).json()['items']
-        videos = list(
-            filter(lambda x: x['id']['kind'] == 'youtube#video', items))
-        if len(videos) > 0:
-            winner = videos[0]
-            image_link = winner['snippet']['thumbnails']['default']['url']
-            media_link = YOUTUBE_LINK_PREFIX + winner['id']['videoId']
-        else:
-            image_link = ''
-            media_link = ''
-        self.multimedia_link_memo[query] = (image_link, media_link)
-        return image_link, media_link
+        return self.youtube.lookup(self.get_query(title, artist), match=is_video, thumbnail='default')
 
     def already_same(self, existing_event, row):
         return existing_event['link'] == row['link'] \
-            and existing_event['image_link'] == row['image_link'] \
-            and existing_event['media_link'] == row['media_link'] \
+            and row['image_link'] in [None, existing_event['image_link']] \
+            and row['media_link'] in [None, existing_event['media_link']] \
             and existing_event['text'] == row['text']
 
     def map_json_array_to_rows(self, json_array, label_id):
@@ -58,15 +155,22 @@ class Billboard(object):
         for jsevt in json_array:
             try:
                 image_link, media_link = self.get_media_link(
-                    jsevt.title, jsevt.artist)
+                    jsevt['title'], jsevt['artist'])
+                text = "{} was on the Billboard charts for {} weeks.".format(
+                    jsevt['title'], str(jsevt['weeks']))
+                if len(jsevt['charts']) > 1:
+                    text += " It was #1 on {} charts.".format(
+                        ', '.join(self.get_chart_title(name) for name in jsevt['charts']))
                 result.append({
-                    'timestamp': self.target_date,
-                    'title': 'Billboard Hot 100 #1 Song: {} by {}'.format(jsevt.title, jsevt.artist),
-                    'text': "{} was on the Billboard charts for {} weeks.".format(jsevt.title, str(jsevt.weeks)),
-                    'link': YOUTUBE_SEARCH_PREFIX + self.get_query(jsevt.title, jsevt.artist),
+                    'timestamp': jsevt['date'],
+                    'title': 'Billboard {} #1 {}: {} by {}'.format(self.get_chart_title(jsevt['charts'][0]), self.get_chart_kind(jsevt['charts'][0]), jsevt['title'], jsevt['artist']),
+                    'text': text,
+                    'link': YOUTUBE_SEARCH_PREFIX + self.get_query(jsevt['title'], jsevt['artist']),
                     'label_id': label_id,
                     'image_link':  image_link,
-                    'media_link':  media_link
+                    'media_link':  media_link,
+                    'month_day': get_month_day(jsevt['date']),
+                    'year': get_year(jsevt['date'])
                 })
             except Exception as exception:
                 self.logger.error('Something unexpected happened: {} {}'.format(
@@ -74,11 +178,11 @@ class Billboard(object):
                     self.target_date))
         return result
 
-    def store_s3(self, s3_bucket):
+    def store_s3(self, storage):
         # Pick the right name for json files.
         if len(self.events) > 0:
-            s3_bucket.Object(key='{}/{}.json'.format(self.label_name,
-                                                     self.target_date)).put(Body=self.chart.json())
+            storage.put_object('{}/{}.json'.format(self.label_name,
+                                                   self.target_date), json.dumps(self.charts, indent=2))
             self.logger.info('Successfully stored {} {} events into S3'.format(
                 self.target_date, len(self.events)))
         else:
@@ -88,22 +192,17 @@ class Billboard(object):
     def store_rds(self, db):
         label_id = db.get_label_id_from_name(self.label_name)
         rows = self.map_json_array_to_rows(self.events, label_id)
-        no_inserts, no_updates, no_notouch = db.store_rds(
-            rows, label_id, self.already_same)
-        self.logger.info('{} Total from json:{:>5} Inserted: {:>5} Updated: {:>5} Up-to-date: {:>5}'.format(
-            self.target_date,
-            len(rows),
-            no_inserts,
-            no_updates,
-            no_notouch
-        ))
+        counts = db.store_rds(rows, label_id, self.already_same)
+        log_store_result(self.logger, self.target_date, rows, counts)
 
 
 def main():
     # Some unit tests
-    b = Billboard()
-    print(b.events)
-    print(b.map_json_array_to_rows(b.events, 5))
+    with profiled('Billboard'):
+        b = Billboard()
+        stage('fetched')
+        print(b.events)
+        print(b.map_json_array_to_rows(b.events, 5))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,41 @@
+import time
+import logging
+
+
+class Checkpoint(object):
+    def __init__(self, store, key, interval=20):
+        self.logger = logging.getLogger(
+            'daily_collector.{}'.format(self.__class__.__name__))
+        self.store = store
+        self.key = key
+        # Seconds between two saves, a save after every step would cost more than the step itself
+        self.interval = interval
+        self.state = store.load(key, default={}) or {}
+        self.last_saved = time.time()
+        if self.state:
+            self.logger.info('Resuming from checkpoint {}'.format(key))
+
+    def reset_if_stale(self, run_key):
+        # A checkpoint left behind by another day's run must not leak into this one
+        if self.state.get('run_key') != run_key:
+            if self.state:
+                self.logger.info('Discarding stale checkpoint {} of {}'.format(
+                    self.key, self.state.get('run_key')))
+            self.state = {'run_key': run_key}
+
+    def section(self, name):
+        return self.state.setdefault(name, {})
+
+    def save(self):
+        self.store.save(self.key, self.state)
+        self.last_saved = time.time()
+        self.logger.debug('Saved checkpoint {}'.format(self.key))
+
+    def maybe_save(self):
+        if time.time() - self.last_saved >= self.interval:
+            self.save()
+
+    def clear(self):
+        self.state = {}
+        self.store.save(self.key, self.state)
+        self.logger.info('Cleared checkpoint {}'.format(self.key))
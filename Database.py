@@ -2,13 +2,34 @@ import os
 import logging
 import sqlalchemy as sa
 
+MIGRATION_BATCH_SIZE = 10000
+
+
+def split_timestamp(timestamp):
+    # Accepts dates, datetimes and strings like 2018-06-21, 2018-06-21T05:00:00+0000 or 70-01-01
+    if hasattr(timestamp, 'year'):
+        return timestamp.year, timestamp.month, timestamp.day
+    date_part = str(timestamp).split('T')[0].split(' ')[0]
+    year, month, day = date_part.rsplit('-', 2)
+    return int(year), int(month), int(day)
+
+
+def get_month_day(timestamp):
+    _, month, day = split_timestamp(timestamp)
+    return '{:02d}-{:02d}'.format(month, day)
+
+
+def get_year(timestamp):
+    return split_timestamp(timestamp)[0]
+
 
 class Database(object):
-    def __init__(self):
+    def __init__(self, database_url=None):
         self.logger = logging.getLogger('daily_collector.Database')
+        self.database_url = database_url or os.environ['DATABASE_URL']
         self.conn = self.get_db_conn()
         self.logger.info('Connected to {}'.format(
-            os.environ['DATABASE_URL'].split('@').pop()))
+            self.database_url.split('@').pop()))
         self.label_table = sa.table('label', sa.column(
             'id', sa.Integer), sa.column('name', sa.Text))
         self.event_table = sa.table('event',
@@ -18,18 +39,21 @@ class Database(object):
                                     sa.column('link', sa.Text),
                                     sa.column('label_id', sa.Integer),
                                     sa.column('image_link', sa.Text),
-                                    sa.column('media_link', sa.Text)
+                                    sa.column('media_link', sa.Text),
+                                    # Precomputed from timestamp for "on this day" reads
+                                    sa.column('month_day', sa.Text),
+                                    sa.column('year', sa.Integer)
                                     )
 
     def get_db_conn(self):
-        engine = sa.create_engine(os.environ['DATABASE_URL'], echo=False)
+        engine = sa.create_engine(self.database_url, echo=False)
         return engine.connect()
 
     def get_label_id_from_name(self, name):
         s = sa.sql.select([self.label_table.c.id, self.label_table.c.name]
                           ).where(self.label_table.c.name == name)
-        result = self.conn.execute(s)
-        if result.rowcount < 1:
+        # rowcount of a SELECT is not reliable on every backend, so look at the row itself
+        if self.conn.execute(s).fetchone() is None:
             ins = self.label_table.insert().values(name=name)
             self.conn.execute(ins)
         result = self.conn.execute(s)
@@ -51,11 +75,20 @@ class Database(object):
         update_count = 0
         inserts = []
         for row in event_rows:
+            row = dict(row)
+            row.setdefault('month_day', get_month_day(row['timestamp']))
+            row.setdefault('year', get_year(row['timestamp']))
             existing_event = self.get_existing_events(
                 label_id, row['timestamp'], row['title']).fetchone()
             if existing_event and len(existing_event) > 0:
                 if not already_same(existing_event, row):
-                    update = self.event_table.update().values(text=row['text'], media_link=row['media_link'], link=row['link'], image_link=row['image_link']).where(sa.and_(
+                    values = {name: row[name] for name in [
+                        'text', 'media_link', 'link', 'image_link', 'month_day', 'year']}
+                    # None means the collector could not look a link up this time, keep the stored one
+                    for name in ['image_link', 'media_link']:
+                        if values[name] is None:
+                            del values[name]
+                    update = self.event_table.update().values(**values).where(sa.and_(
                         self.event_table.c.label_id == label_id,
                         self.event_table.c.timestamp == row['timestamp'],
                         self.event_table.c.title == row['title']
@@ -70,3 +103,43 @@ class Database(object):
             ins = self.event_table.insert().values(inserts)
             self.conn.execute(ins)
         return len(inserts), update_count, already_same_count
+
+    def get_events_on_day(self, month_day):
+        # Served by the (month_day, label_id) index
+        s = sa.sql.select([self.label_table.c.name.label('label_name'), self.event_table.c.timestamp, self.event_table.c.title, self.event_table.c.text, self.event_table.c.link, self.event_table.c.image_link, self.event_table.c.media_link]).select_from(
+            self.event_table.join(
+                self.label_table, self.event_table.c.label_id == self.label_table.c.id)
+        ).where(self.event_table.c.month_day == month_day)
+        return self.conn.execute(s).fetchall()
+
+    def migrate_month_day(self):
+        # One-off PostgreSQL migration: add the columns, backfill them in batches, then add the index
+        # Rows without a timestamp keep a NULL month_day, so they are left out or the loop never ends
+        self.conn.execute(
+            'ALTER TABLE event ADD COLUMN IF NOT EXISTS month_day TEXT')
+        self.conn.execute(
+            'ALTER TABLE event ADD COLUMN IF NOT EXISTS year INTEGER')
+        total = 0
+        while True:
+            result = self.conn.execute(sa.text('''UPDATE event
+                SET month_day = to_char(timestamp, 'MM-DD'), year = EXTRACT(YEAR FROM timestamp)
+                WHERE ctid IN (SELECT ctid FROM event WHERE month_day IS NULL AND timestamp IS NOT NULL LIMIT :batch_size)'''),
+                batch_size=MIGRATION_BATCH_SIZE)
+            if result.rowcount < 1:
+                break
+            total += result.rowcount
+            self.logger.info('Backfilled {} events so far'.format(total))
+        self.logger.info('Backfill done, {} events backfilled'.format(total))
+        # Built after the backfill and without blocking writes, so collectors can keep running.
+        # CONCURRENTLY cannot run in a transaction; if it fails it leaves an INVALID index to drop before retrying
+        self.conn.execution_options(isolation_level='AUTOCOMMIT').execute(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS event_month_day_label_id_idx ON event (month_day, label_id)')
+        self.logger.info('Migration done')
+
+
+def main():
+    Database().migrate_month_day()
+
+
+if __name__ == '__main__':
+    main()
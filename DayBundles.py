@@ -0,0 +1,94 @@
+import gzip
+import json
+import hashlib
+import logging
+from datetime import datetime
+
+BUNDLE_KEY = 'DayBundles/{}.json.gz'
+MANIFEST_KEY = 'DayBundles/manifest.json'
+MAX_EVENTS_PER_LABEL = 100
+CACHE_CONTROL = 'public, max-age=3600'
+
+
+def format_timestamp(timestamp):
+    # Databases hand back datetimes, SQLite hands back strings
+    if hasattr(timestamp, 'date'):
+        return timestamp.date().isoformat()
+    return str(timestamp).split(' ')[0]
+
+
+class DayBundles(object):
+    def __init__(self, db, object_sink, state_store, max_per_label=MAX_EVENTS_PER_LABEL):
+        self.logger = logging.getLogger(
+            'daily_collector.{}'.format(self.__class__.__name__))
+        self.db = db
+        self.object_sink = object_sink
+        self.state_store = state_store
+        self.max_per_label = max_per_label
+        self.manifest = state_store.load(
+            MANIFEST_KEY, default=None) or {'version': 0, 'days': {}}
+
+    def get_payload(self, month_day):
+        labels = {}
+        for row in self.db.get_events_on_day(month_day):
+            labels.setdefault(row['label_name'], []).append({
+                'date': format_timestamp(row['timestamp']),
+                'title': row['title'],
+                'text': row['text'],
+                'link': row['link'],
+                'image_link': row['image_link'],
+                'media_link': row['media_link']
+            })
+        # Most recent first, then capped so a busy day does not grow the bundle without bound
+        for name in labels:
+            labels[name] = sorted(labels[name], key=lambda e: (
+                e['date'], e['title']), reverse=True)[:self.max_per_label]
+        return {'month_day': month_day, 'labels': labels}
+
+    def render(self, month_day):
+        # Returns whether the bundle changed and was written
+        payload = self.get_payload(month_day)
+        content = json.dumps(payload, sort_keys=True, separators=(',', ':'))
+        content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        previous = self.manifest['days'].get(month_day, {})
+        if previous.get('hash') == content_hash:
+            self.logger.debug('Bundle of {} unchanged'.format(month_day))
+            return False
+        payload['hash'] = content_hash
+        payload['version'] = previous.get('version', 0) + 1
+        body = gzip.compress(json.dumps(payload, sort_keys=True, separators=(
+            ',', ':')).encode('utf-8'), mtime=0)
+        self.object_sink.put_object(BUNDLE_KEY.format(month_day), body,
+                                    ContentType='application/json',
+                                    ContentEncoding='gzip',
+                                    CacheControl=CACHE_CONTROL)
+        self.manifest['days'][month_day] = {
+            'key': BUNDLE_KEY.format(month_day),
+            'hash': content_hash,
+            'version': payload['version'],
+            'events': sum([len(events) for events in payload['labels'].values()])
+        }
+        return True
+
+    def merge_manifest(self, changed):
+        # Shard workers render concurrently, so keep the days others saved since the manifest was loaded
+        stored = self.state_store.load(MANIFEST_KEY, default=None)
+        if not stored:
+            return
+        for month_day, entry in stored['days'].items():
+            if month_day not in changed:
+                self.manifest['days'][month_day] = entry
+        self.manifest['version'] = max(
+            self.manifest['version'], stored['version'])
+
+    def render_days(self, month_days):
+        changed = [md for md in sorted(month_days) if self.render(md)]
+        if changed:
+            self.merge_manifest(changed)
+            self.manifest['version'] += 1
+            self.manifest['updated'] = datetime.utcnow().isoformat()
+            # The manifest goes last, so it never points at a bundle that is not written yet
+            self.state_store.save(MANIFEST_KEY, self.manifest)
+        self.logger.info('Rendered {} of {} touched days, manifest version {}'.format(
+            len(changed), len(month_days), self.manifest['version']))
+        return changed
@@ -0,0 +1,120 @@
+import uuid
+import logging
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pyarrow import fs
+
+EVENT_SCHEMA = pa.schema([
+    ('timestamp', pa.string()),
+    ('title', pa.string()),
+    ('text', pa.string()),
+    ('link', pa.string()),
+    ('label_id', pa.int64()),
+    ('image_link', pa.string()),
+    ('media_link', pa.string()),
+    ('month_day', pa.string()),
+    ('year', pa.int32())
+])
+PARTITIONING = ds.partitioning(
+    pa.schema([('label', pa.string()), ('year', pa.int32())]), flavor='hive')
+# Rows are re-exported whenever a collector stores them again, the last copy wins
+DEDUPE_KEY = ['label_id', 'timestamp', 'title']
+MAX_FILES_PER_PARTITION = 8
+
+
+def get_filesystem(root):
+    # root is a local directory or an s3://bucket/prefix URI
+    filesystem, path = fs.FileSystem.from_uri(root) if '://' in root else (
+        fs.LocalFileSystem(), root)
+    return filesystem, path.rstrip('/')
+
+
+def dedupe(table):
+    # Rows come oldest file first, so the last occurrence of a key is the newest row
+    keys = zip(*[table.column(name).to_pylist() for name in DEDUPE_KEY])
+    last_index = {}
+    for i, key in enumerate(keys):
+        last_index[key] = i
+    return table.take(pa.array(sorted(last_index.values()), type=pa.int64()))
+
+
+def read_events(root, labels=None, years=None, columns=None):
+    # One vectorized scan over every partition matching labels and years
+    filesystem, path = get_filesystem(root)
+    dataset = ds.dataset(path, filesystem=filesystem, format='parquet',
+                         partitioning=PARTITIONING)
+    condition = None
+    if labels:
+        condition = ds.field('label').isin(labels)
+    if years:
+        year_condition = ds.field('year').isin(years)
+        condition = year_condition if condition is None else condition & year_condition
+    # Partitions not compacted yet hold every re-export, so duplicates are dropped here too
+    scan_columns = None if columns is None else list(
+        columns) + [name for name in DEDUPE_KEY if name not in columns]
+    table = dedupe(dataset.to_table(columns=scan_columns, filter=condition))
+    return table if columns is None else table.select(columns)
+
+
+class Exporter(object):
+    def __init__(self, root, max_files=MAX_FILES_PER_PARTITION):
+        self.logger = logging.getLogger(
+            'daily_collector.{}'.format(self.__class__.__name__))
+        self.root = root
+        self.filesystem, self.path = get_filesystem(root)
+        self.max_files = max_files
+
+    def get_partition_dir(self, label_name, year):
+        return '{}/label={}/year={}'.format(self.path, label_name, year)
+
+    def append(self, label_name, rows):
+        # Each call adds one new file per year, compact() merges them later
+        if not rows:
+            return 0
+        by_year = {}
+        for row in rows:
+            by_year.setdefault(row['year'], []).append(row)
+        run_id = '{}-{}'.format(datetime.utcnow().strftime('%Y%m%d%H%M%S%f'),
+                                uuid.uuid4().hex[:8])
+        for year, year_rows in by_year.items():
+            table = pa.Table.from_pylist(
+                [{name: row.get(name) for name in EVENT_SCHEMA.names} for row in year_rows], schema=EVENT_SCHEMA)
+            partition_dir = self.get_partition_dir(label_name, year)
+            self.filesystem.create_dir(partition_dir, recursive=True)
+            pq.write_table(table, '{}/part-{}.parquet'.format(partition_dir, run_id),
+                           filesystem=self.filesystem)
+        self.logger.info('Exported {} {} rows into {} partitions'.format(
+            len(rows), label_name, len(by_year)))
+        return len(rows)
+
+    def list_partitions(self, label_name):
+        selector = fs.FileSelector('{}/label={}'.format(self.path, label_name),
+                                   allow_not_found=True)
+        return [info.path for info in self.filesystem.get_file_info(selector)
+                if info.type == fs.FileType.Directory]
+
+    def compact(self, label_names):
+        # Merge partitions that collected too many small files into one deduplicated file
+        compacted = 0
+        for label_name in label_names:
+            for partition_dir in self.list_partitions(label_name):
+                files = sorted(info.path for info in self.filesystem.get_file_info(
+                    fs.FileSelector(partition_dir)) if info.path.endswith('.parquet'))
+                if len(files) < self.max_files:
+                    continue
+                table = pa.concat_tables(
+                    [pq.read_table(f, filesystem=self.filesystem, schema=EVENT_SCHEMA) for f in files])
+                table = dedupe(table)
+                target = '{}/compacted-{}.parquet'.format(
+                    partition_dir, datetime.utcnow().strftime('%Y%m%d%H%M%S%f'))
+                pq.write_table(table, target, filesystem=self.filesystem)
+                # Old files go only once the compacted one is written
+                for f in files:
+                    self.filesystem.delete_file(f)
+                compacted += 1
+                self.logger.info('Compacted {} files of {} into {} rows'.format(
+                    len(files), partition_dir, table.num_rows))
+        return compacted
@@ -0,0 +1,132 @@
+import time
+import hashlib
+import logging
+import threading
+from urllib.parse import urlencode, urlparse
+
+import requests
+
+from JsonStore import MemoryJsonStore
+
+INDEX_KEY = 'HttpCache/index.json'
+BODY_KEY = 'HttpCache/bodies/{}.json'
+MAX_BYTES = 64 * 2**20
+# Seconds a response is served without asking the host again; after that it is revalidated
+HOST_POLICIES = {
+    # Published weekly charts do not change
+    'www.the-numbers.com': 24 * 3600,
+    'en.wikipedia.org': 12 * 3600
+}
+
+
+class CachedResponse(object):
+    def __init__(self, url, status_code, text, from_cache):
+        self.url = url
+        self.status_code = status_code
+        self.text = text
+        self.from_cache = from_cache
+
+
+class HttpCache(object):
+    def __init__(self, store=None, policies=None, max_bytes=MAX_BYTES, timeout=25):
+        self.logger = logging.getLogger(
+            'daily_collector.{}'.format(self.__class__.__name__))
+        self.store = store or MemoryJsonStore()
+        self.policies = HOST_POLICIES if policies is None else policies
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # url key -> validators, size and times of the cached body
+        self.index = self.store.load(INDEX_KEY, default={}) or {}
+        # url key -> time this cache evicted it, so merging does not bring it back
+        self.evicted = {}
+
+    def get_key(self, url, params):
+        full_url = url + ('?' + urlencode(sorted(params.items())) if params else '')
+        return hashlib.sha1(full_url.encode('utf-8')).hexdigest(), full_url
+
+    def get_ttl(self, url):
+        return self.policies.get(urlparse(url).netloc, 0)
+
+    def get(self, url, params=None):
+        key, full_url = self.get_key(url, params)
+        with self.lock:
+            entry = self.index.get(key)
+        if entry and time.time() - entry['fetched'] < self.get_ttl(url):
+            body = self.load_body(key)
+            if body is not None:
+                self.logger.debug('Fresh in cache: {}'.format(full_url))
+                self.touch(key)
+                return CachedResponse(full_url, 200, body, True)
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        r = requests.get(url, params=params, headers=headers,
+                         timeout=self.timeout)
+        if r.status_code == 304 and entry:
+            body = self.load_body(key)
+            if body is not None:
+                self.logger.info('Not modified: {}'.format(full_url))
+                with self.lock:
+                    entry['fetched'] = time.time()
+                self.touch(key)
+                return CachedResponse(full_url, 200, body, True)
+            # The body was evicted behind our back, ask again without validators
+            r = requests.get(url, params=params, timeout=self.timeout)
+        if r.status_code == 200:
+            self.put(key, full_url, r)
+        return CachedResponse(full_url, r.status_code, r.text, False)
+
+    def load_body(self, key):
+        try:
+            body = self.store.load(BODY_KEY.format(key))
+        except Exception as exception:
+            self.logger.warn('Could not read cached body {}: {}'.format(
+                key, type(exception).__name__))
+            return None
+        return body['text'] if body else None
+
+    def touch(self, key):
+        with self.lock:
+            if key in self.index:
+                self.index[key]['used'] = time.time()
+            self.save_index()
+
+    def put(self, key, full_url, r):
+        self.store.save(BODY_KEY.format(key), {
+                        'url': full_url, 'text': r.text})
+        with self.lock:
+            self.index[key] = {
+                'url': full_url,
+                'etag': r.headers.get('ETag'),
+                'last_modified': r.headers.get('Last-Modified'),
+                'size': len(r.text),
+                'fetched': time.time(),
+                'used': time.time()
+            }
+            self.save_index()
+
+    def save_index(self):
+        # Other collectors share the index, so keep whatever they saved since it was loaded
+        stored = self.store.load(INDEX_KEY, default={}) or {}
+        for key, entry in stored.items():
+            if entry['fetched'] <= self.evicted.get(key, 0):
+                continue
+            if key not in self.index or entry['used'] > self.index[key]['used']:
+                self.index[key] = entry
+        self.evict()
+        self.store.save(INDEX_KEY, self.index)
+
+    def evict(self):
+        # Least recently used bodies go first until the cache fits in max_bytes
+        total = sum(entry['size'] for entry in self.index.values())
+        for key in sorted(self.index, key=lambda k: self.index[k]['used']):
+            if total <= self.max_bytes:
+                break
+            total -= self.index[key]['size']
+            self.logger.info('Evicting {}'.format(self.index[key]['url']))
+            del self.index[key]
+            self.evicted[key] = time.time()
+            self.store.delete(BODY_KEY.format(key))
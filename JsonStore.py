@@ -0,0 +1,81 @@
+import os
+import json
+import logging
+
+import boto3
+from botocore.exceptions import ClientError
+
+
+class S3JsonStore(object):
+    def __init__(self, bucket_name):
+        self.logger = logging.getLogger(
+            'daily_collector.{}'.format(self.__class__.__name__))
+        # Collectors load and save from worker threads, and clients are thread safe while resources are not
+        self.s3 = boto3.client('s3')
+        self.bucket_name = bucket_name
+
+    def load(self, key, default=None):
+        try:
+            body = self.s3.get_object(
+                Bucket=self.bucket_name, Key=key)['Body']
+        except ClientError as error:
+            if error.response['Error']['Code'] in ['NoSuchKey', '404']:
+                self.logger.info('{} does not exist yet in S3'.format(key))
+                return default
+            raise
+        return json.load(body)
+
+    def save(self, key, obj):
+        self.s3.put_object(Bucket=self.bucket_name, Key=key,
+                           Body=json.dumps(obj, indent=2))
+
+    def delete(self, key):
+        self.s3.delete_object(Bucket=self.bucket_name, Key=key)
+
+
+class LocalJsonStore(object):
+    def __init__(self, root_dir='.'):
+        self.logger = logging.getLogger(
+            'daily_collector.{}'.format(self.__class__.__name__))
+        self.root_dir = root_dir
+
+    def get_path(self, key):
+        return os.path.join(self.root_dir, *key.split('/'))
+
+    def load(self, key, default=None):
+        path = self.get_path(key)
+        if not os.path.exists(path):
+            self.logger.info('{} does not exist yet locally'.format(path))
+            return default
+        with open(path) as r:
+            return json.load(r)
+
+    def save(self, key, obj):
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # Write to a temporary file first so a crash never leaves half a file
+        with open(path + '.tmp', 'w') as w:
+            json.dump(obj, w, indent=2)
+        os.replace(path + '.tmp', path)
+
+    def delete(self, key):
+        path = self.get_path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class MemoryJsonStore(object):
+    # Keeps objects for the lifetime of the process only
+    def __init__(self):
+        self.objects = {}
+
+    def load(self, key, default=None):
+        if key not in self.objects:
+            return default
+        return json.loads(self.objects[key])
+
+    def save(self, key, obj):
+        self.objects[key] = json.dumps(obj)
+
+    def delete(self, key):
+        self.objects.pop(key, None)
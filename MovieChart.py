@@ -1,13 +1,23 @@
 import datetime
 import json
-from requests_html import HTMLSession
+from requests_html import HTML
+
+from HttpCache import HttpCache
+from Profiling import profiled
 
 THE_NUMBERS_URL = "https://www.the-numbers.com/box-office-chart/"
 
 
+def get_chart_week_start(date):
+    # Weekly and weekend charts are dated on the Friday their week starts
+    return date - datetime.timedelta(days=(date.weekday() - 4) % 7)
+
+
 class MovieChart(object):
-    def __init__(self, target_date=datetime.datetime.now()):
+    def __init__(self, target_date=datetime.datetime.now(), http_cache=None):
         self.target_date = target_date
+        # Every day of a week asks for the same chart URL, so the cached page is reused
+        self.http_cache = http_cache or HttpCache()
         self.movies = self.getMovies()
 
     def getMovies(self):
@@ -15,27 +25,32 @@ class MovieChart(object):
         return movies
 
     def get_movies_for_day(self, date):
-        chart = self.get_weekly_chart(date.year, date.month, date.day)
+        week_start = get_chart_week_start(date)
+        chart = self.get_weekly_chart(
+            week_start.year, week_start.month, week_start.day)
         if len(chart) < 1:
-            chart = self.get_weekend_chart(date.year, date.month, date.day)
+            chart = self.get_weekend_chart(
+                week_start.year, week_start.month, week_start.day)
         if len(chart) < 1:
             return []
         return chart
 
     def get_weekly_chart(self, year, month, date):
-        session = HTMLSession()
-        raw_html = session.get(
+        raw_html = self.get_html(
             THE_NUMBERS_URL + "weekly/{}/{}/{}".format(year, month, date))
         return self.get_chart(raw_html)
 
     def get_weekend_chart(self, year, month, date):
-        session = HTMLSession()
-        raw_html = session.get(
+        raw_html = self.get_html(
             THE_NUMBERS_URL + "weekend/{}/{}/{}".format(year, month, date))
         return self.get_chart(raw_html)
 
+    def get_html(self, url):
+        r = self.http_cache.get(url)
+        return HTML(html=r.text, url=url)
+
     def get_chart(self, raw_html):
-        table = raw_html.html.find("#page_filling_chart table", first=True)
+        table = raw_html.find("#page_filling_chart table", first=True)
         # Ignore the first row because it is the table's headings
         rows = table.find("tr")[1:]
         keys = ["current_week_rank", "previous_week_rank", "movie", "distributor",
@@ -52,8 +67,9 @@ class MovieChart(object):
 
 def main():
     # Unit Test
-    mc = MovieChart()
-    print(mc.movies)
+    with profiled('MovieChart'):
+        mc = MovieChart()
+        print(mc.movies)
 
 
 if __name__ == '__main__':
@@ -1,28 +1,28 @@
 #!/usr/bin/env python3
-import os
 import re
 import json
 import logging
 import datetime
 
-import requests
 from requests_html import HTMLSession
 from MovieChart import MovieChart
+from YouTube import YouTube, is_trailer
+from Storage import log_store_result
+from Database import get_month_day, get_year
+from Profiling import profiled, stage
 
-YOUTUBE_API = 'https://www.googleapis.com/youtube/v3/search'
-YOUTUBE_LINK_PREFIX = 'https://www.youtube.com/watch?v='
 IMDB_SEARCH_PREFIX = 'https://www.imdb.com/find?q='
 
 
 class Movies(object):
-    def __init__(self, target_date=datetime.datetime.now()):
+    def __init__(self, target_date=datetime.datetime.now(), youtube=None, http_cache=None):
         self.target_date = target_date
-        self.chart = MovieChart(self.target_date)
+        self.chart = MovieChart(self.target_date, http_cache=http_cache)
         self.label_name = 'Movies'
         self.logger = logging.getLogger(
             'daily_collector.{}'.format(self.__class__.__name__))
         self.events = self.get_top_movie()
-        self.multimedia_link_memo = {}
+        self.youtube = youtube or YouTube()
 
     def get_top_movie(self):
         if len(self.chart.movies) < 1:
@@ -36,26 +36,7 @@ class Movies(object):
 
     def get_media_link(self, title):
         query = self.get_query(title + " official movie trailer")
-        if query in self.multimedia_link_memo:
-            return self.multimedia_link_memo[query]
-        payload = {
-            'q': query,
-            'maxResult': 5,
-            'key': os.environ['YOUTUBE_API_KEY'],
-            'part': 'snippet'
-        }
-        items = requests.get(YOUTUBE_API, params=payload).json()['items']
-        videos = list(
-            filter(lambda x: x['id']['kind'] == 'youtube#video' and 'Trailer' in x['snippet']['title'], items))
-        if len(videos) > 0:
-            winner = videos[0]
-            image_link = winner['snippet']['thumbnails']['high']['url']
-            media_link = YOUTUBE_LINK_PREFIX + winner['id']['videoId']
-        else:
-            image_link = ''
-            media_link = ''
-        self.multimedia_link_memo[query] = (image_link, media_link)
-        return image_link, media_link
+        return self.youtube.lookup(query, match=is_trailer, thumbnail='high')
 
     def map_json_array_to_rows(self, json_array, label_id):
         result = []
@@ -70,7 +51,9 @@ class Movies(object):
                     'link': IMDB_SEARCH_PREFIX + self.get_query(title),
                     'label_id': label_id,
                     'image_link':  image_link,
-                    'media_link':  media_link
+                    'media_link':  media_link,
+                    'month_day': get_month_day(self.target_date),
+                    'year': get_year(self.target_date)
                 })
             except Exception as exception:
                 self.logger.error('Something unexpected happened: {} {}'.format(
@@ -80,15 +63,15 @@ class Movies(object):
 
     def already_same(self, existing_event, row):
         return existing_event['link'] == row['link'] \
-            and existing_event['image_link'] == row['image_link'] \
-            and existing_event['media_link'] == row['media_link'] \
+            and row['image_link'] in [None, existing_event['image_link']] \
+            and row['media_link'] in [None, existing_event['media_link']] \
             and existing_event['text'] == row['text']
 
-    def store_s3(self, s3_bucket):
+    def store_s3(self, storage):
         # Pick the right name for json files.
         if len(self.events) > 0:
-            s3_bucket.Object(key='{}/{}.json'.format(self.label_name,
-                                                     self.target_date.strftime("%Y-%m-%d"))).put(Body=json.dumps(self.events, indent=2))
+            storage.put_object('{}/{}.json'.format(self.label_name,
+                                                   self.target_date.strftime("%Y-%m-%d")), json.dumps(self.events, indent=2))
             self.logger.info('Successfully stored {} {} events into S3'.format(
                 self.target_date, len(self.events)))
         else:
@@ -98,26 +81,21 @@ class Movies(object):
     def store_rds(self, db):
         label_id = db.get_label_id_from_name(self.label_name)
         rows = self.map_json_array_to_rows(self.events, label_id)
-        no_inserts, no_updates, no_notouch = db.store_rds(
-            rows, label_id, self.already_same)
-        self.logger.info('{} Total from json:{:>5} Inserted: {:>5} Updated: {:>5} Up-to-date: {:>5}'.format(
-            self.target_date,
-            len(rows),
-            no_inserts,
-            no_updates,
-            no_notouch
-        ))
+        counts = db.store_rds(rows, label_id, self.already_same)
+        log_store_result(self.logger, self.target_date, rows, counts)
 
 
 def main():
     # Some unit tests
-    m = Movies()
-    if m.events == []:
-        print("None")
-    else:
-        print(m.target_date.strftime("%Y-%m-%d"))
-        print(m.chart.movies[0])
-        print(m.map_json_array_to_rows(m.events, 5))
+    with profiled('Movies'):
+        m = Movies()
+        stage('fetched')
+        if m.events == []:
+            print("None")
+        else:
+            print(m.target_date.strftime("%Y-%m-%d"))
+            print(m.chart.movies[0])
+            print(m.map_json_array_to_rows(m.events, 5))
 
 
 if __name__ == '__main__':
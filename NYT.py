@@ -7,12 +7,18 @@ from datetime import timedelta, date
 
 import requests
 
+from Checkpoint import Checkpoint
+from JsonStore import MemoryJsonStore
+from Storage import log_store_result
+from Database import get_month_day, get_year
+from Profiling import profiled
+
 NYT_ARTICLE_SEARCH_EP = 'https://api.nytimes.com/svc/search/v2/articlesearch.json'
 FILTER_WORDS = ['-- No Title$']
 
 
 class NYT(object):
-    def __init__(self):
+    def __init__(self, checkpoint=None):
         self.label_name = 'New-York-Times'
         self.logger = logging.getLogger(
             'daily_collector.{}'.format(self.__class__.__name__))
@@ -22,11 +28,19 @@ class NYT(object):
         self.error_count = 0
 
         self.target_date = date.today() - timedelta(days=2)
+        self.checkpoint = checkpoint or Checkpoint(
+            MemoryJsonStore(), self.label_name)
+        self.checkpoint.reset_if_stale(
+            self.format_date(self.target_date, with_hyphen=True))
         cursor_date = self.target_date
-        self.events = []
+        self.events_by_day = {}
         while cursor_date <= date.today():
-            self.events.extend(self.process_one_day(cursor_date))
+            self.events_by_day[self.format_date(cursor_date)] = self.process_one_day(
+                cursor_date)
             cursor_date = cursor_date + timedelta(days=1)
+        self.events = [e for day in sorted(self.events_by_day)
+                       for e in self.events_by_day[day]]
+        self.checkpoint.save()
 
     def already_same(self, existing_event, row):
         return existing_event['link'] == row['link'] \
@@ -67,7 +81,9 @@ class NYT(object):
                         'link': jsevt['web_url'],
                         'label_id': label_id,
                         'image_link': 'https://www.nytimes.com/' + next(filter(lambda e: e['subtype'] in ['xlarge', 'wide'], jsevt['multimedia']))['url'],
-                        'media_link': ''
+                        'media_link': '',
+                        'month_day': get_month_day(jsevt['pub_date']),
+                        'year': get_year(jsevt['pub_date'])
                     })
             except Exception as exception:
                 self.logger.error('{} {}'.format(
@@ -86,10 +102,10 @@ class NYT(object):
                 seen_article.add(title)
         return result
 
-    def store_s3(self, s3_bucket):
+    def store_s3(self, storage):
         if len(self.events) > 0:
-            s3_bucket.Object(key='{}/{}.json'.format(self.label_name,
-                                                     self.format_date(self.target_date, with_hyphen=True))).put(Body=json.dumps(self.events, indent=2))
+            storage.put_object('{}/{}.json'.format(self.label_name,
+                                                   self.format_date(self.target_date, with_hyphen=True)), json.dumps(self.events, indent=2))
             self.logger.info('Successfully stored {} {} events into S3'.format(
                 self.format_date(self.target_date), len(self.events)))
         else:
@@ -98,16 +114,11 @@ class NYT(object):
 
     def store_rds(self, db):
         label_id = db.get_label_id_from_name(self.label_name)
-        rows = self.map_json_array_to_rows(self.events, label_id)
-        no_inserts, no_updates, no_notouch = db.store_rds(
-            rows, label_id, self.already_same)
-        self.logger.info('{} Total from json:{:>5} Inserted: {:>5} Updated: {:>5} Up-to-date: {:>5}'.format(
-            self.target_date,
-            len(rows),
-            no_inserts,
-            no_updates,
-            no_notouch
-        ))
+        # Rows are upserted, so a run resumed from the checkpoint can safely store them again
+        for day in sorted(self.events_by_day):
+            rows = self.map_json_array_to_rows(self.events_by_day[day], label_id)
+            counts = db.store_rds(rows, label_id, self.already_same)
+            log_store_result(self.logger, day, rows, counts)
 
     def process_one_day(self, date):
         result = self.get_one_day(date)
@@ -115,23 +126,36 @@ class NYT(object):
         return result
 
     def get_one_day(self, target_date):
-        result = []
-        one_batch = self.get_one_batch(target_date)
+        progress = self.checkpoint.section('days').setdefault(
+            self.format_date(target_date), {'pages': 0, 'docs': [], 'complete': False})
+        result = progress['docs']
+        if progress['complete']:
+            self.logger.info('{} restored from checkpoint with {} articles'.format(
+                self.format_date(target_date), len(result)))
+            return result
+        current_page = progress['pages']
+        one_batch = self.get_one_batch(target_date, page_number=current_page)
         num_pages = one_batch['response']['meta']['hits'] // 10 + 1
-        current_page = 0
         while (current_page < num_pages):
             try:
                 self.logger.info('Processing for {}, progress of pages: {}/{}'.format(
                     self.format_date(target_date), current_page+1, num_pages))
                 current_page += 1
                 result.extend(one_batch['response']['docs'])
-                time.sleep(1)
-                one_batch = self.get_one_batch(
-                    target_date, page_number=current_page)
+                progress['pages'] = current_page
+                self.checkpoint.maybe_save()
+                if current_page < num_pages:
+                    time.sleep(1)
+                    one_batch = self.get_one_batch(
+                        target_date, page_number=current_page)
             except:
                 self.logger.warn(
                     'Something unexpected happened and returning the results up to this point')
-                return result
+                break
+        else:
+            # Only a day fetched to its last page is complete, a resumed run continues a broken one from pages
+            progress['complete'] = True
+        self.checkpoint.save()
         return result
 
     def retry_api_call(self, endpoint, payload):
@@ -166,8 +190,9 @@ class NYT(object):
 
 
 def main():
-    nyt = NYT()
-    print(len(nyt.events))
+    with profiled('NYT'):
+        nyt = NYT()
+        print(len(nyt.events))
 
 
 if __name__ == '__main__':
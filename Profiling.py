@@ -0,0 +1,231 @@
+import io
+import os
+import sys
+import time
+import pstats
+import uuid
+import marshal
+import logging
+import cProfile
+import argparse
+import threading
+import tracemalloc
+from datetime import datetime
+from collections import Counter
+
+from Storage import S3Sink, LocalFileSink
+
+PROFILE_ENV = 'DEJAVIEW_PROFILE'
+PROFILE_OUTPUT_ENV = 'DEJAVIEW_PROFILE_OUTPUT'
+PROFILE_MODES = ['cprofile', 'sampling']
+# Run date, then collector name, time and request id, so concurrent invocations never share a key
+PROFILE_KEY = 'Profiles/{}/{}.{}'
+# Lambda can only write to /tmp, which is gone after the invocation, so profiles go to the bucket there
+DEFAULT_OUTPUT = 's3' if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') else 'profiles'
+TOP_N = 30
+
+# The profiler of the running collector, if any, so stage() can be called from anywhere
+active_profiler = None
+
+
+def get_profile_options(argv=None):
+    # --profile / --profile-output on the command line win over the environment variables
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--profile', nargs='?', const=PROFILE_MODES[0],
+                        default=os.environ.get(PROFILE_ENV) or None)
+    parser.add_argument('--profile-output',
+                        default=os.environ.get(PROFILE_OUTPUT_ENV, DEFAULT_OUTPUT))
+    args, _ = parser.parse_known_args(sys.argv[1:] if argv is None else argv)
+    mode = args.profile
+    if mode and mode not in PROFILE_MODES:
+        # Any other non-empty value, like DEJAVIEW_PROFILE=1, means the deterministic profiler
+        mode = PROFILE_MODES[0]
+    return mode, args.profile_output
+
+
+def get_output_sink(output):
+    # 's3' means the bucket in BUCKET_NAME, anything else is a local directory
+    if output == 's3':
+        return S3Sink(os.environ['BUCKET_NAME'])
+    return LocalFileSink(output)
+
+
+def stage(name):
+    if active_profiler:
+        active_profiler.stage(name)
+
+
+class SamplingProfiler(object):
+    # Samples the stacks of every thread from a background thread, cheap enough for Lambda
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def enable(self):
+        self.thread.start()
+
+    def disable(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.thread.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{}:{}:{}'.format(os.path.basename(
+                        code.co_filename), code.co_name, code.co_firstlineno))
+                    frame = frame.f_back
+                # The thread name is the root frame, so fetch pools and storage workers show apart
+                stack.append('thread:{}'.format(names.get(thread_id, thread_id)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def dump(self):
+        # Collapsed stacks, the input format of flamegraph.pl and speedscope
+        return '\n'.join('{} {}'.format(stack, count) for stack, count in self.stacks.most_common()).encode('utf-8')
+
+    def summary(self, top_n):
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            for one_frame in set(frames):
+                total[one_frame] += count
+        lines = ['{} samples every {}s'.format(self.samples, self.interval),
+                 '{:>8} {:>8}  function'.format('own', 'total')]
+        for one_frame, count in own.most_common(top_n):
+            lines.append('{:>8} {:>8}  {}'.format(
+                count, total[one_frame], one_frame))
+        return '\n'.join(lines)
+
+
+class DeterministicProfiler(object):
+    # cProfile only sees the thread it is enabled in, so threads started meanwhile get their own
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.thread_profiles = []
+        self.lock = threading.Lock()
+
+    def enable(self):
+        threading.setprofile(self.start_thread)
+        self.profile.enable()
+
+    def start_thread(self, frame, event, arg):
+        profile = cProfile.Profile()
+        with self.lock:
+            self.thread_profiles.append(profile)
+        # Replaces this hook for the rest of the thread
+        profile.enable()
+
+    def disable(self):
+        self.profile.disable()
+        threading.setprofile(None)
+
+    def get_stats(self, stream=None):
+        # All threads merged into one
+        stats = pstats.Stats(self.profile, stream=stream)
+        for profile in self.thread_profiles:
+            profile.create_stats()
+            if profile.stats:
+                stats.add(profile)
+        return stats
+
+    def dump(self):
+        # Same format as Profile.dump_stats, loadable with pstats.Stats
+        return marshal.dumps(self.get_stats().stats)
+
+    def summary(self, top_n):
+        stream = io.StringIO()
+        self.get_stats(stream=stream).sort_stats(
+            'cumulative').print_stats(top_n)
+        return stream.getvalue()
+
+
+class Profiler(object):
+    def __init__(self, name, mode=None, output=DEFAULT_OUTPUT, top_n=TOP_N, run_id=None):
+        self.logger = logging.getLogger(
+            'daily_collector.{}'.format(self.__class__.__name__))
+        self.name = name
+        self.mode = mode
+        self.output = output
+        self.top_n = top_n
+        now = datetime.now()
+        self.run_date = now.strftime('%Y-%m-%d')
+        self.run_name = '{}-{}-{}'.format(name, now.strftime('%H%M%S'),
+                                          run_id or uuid.uuid4().hex[:8])
+        self.stages = []
+        self.profiler = None
+
+    def __enter__(self):
+        global active_profiler
+        if not self.mode:
+            return self
+        self.logger.info('Profiling {} with {}'.format(self.name, self.mode))
+        tracemalloc.start()
+        self.started = time.time()
+        self.profiler = SamplingProfiler() if self.mode == 'sampling' else DeterministicProfiler()
+        self.profiler.enable()
+        active_profiler = self
+        self.stage('start')
+        return self
+
+    def stage(self, name):
+        if not self.profiler:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        top = snapshot.statistics('lineno')[:5]
+        self.stages.append('{} at {:.1f}s: current {:.1f} MiB, peak {:.1f} MiB\n{}'.format(
+            name,
+            time.time() - self.started,
+            current / 2**20,
+            peak / 2**20,
+            '\n'.join('    {}'.format(stat) for stat in top)))
+
+    def __exit__(self, *args):
+        global active_profiler
+        if not self.profiler:
+            return False
+        self.stage('end')
+        self.profiler.disable()
+        active_profiler = None
+        tracemalloc.stop()
+        self.store()
+        return False
+
+    def store(self):
+        sink = get_output_sink(self.output)
+        extension = 'collapsed' if self.mode == 'sampling' else 'prof'
+        summary = '{} {} profile of {}\n\nTop {} functions\n{}\n\nMemory by stage\n{}\n'.format(
+            self.run_date,
+            self.mode,
+            self.name,
+            self.top_n,
+            self.profiler.summary(self.top_n),
+            '\n'.join(self.stages))
+        try:
+            sink.put_object(PROFILE_KEY.format(
+                self.run_date, self.run_name, extension), self.profiler.dump())
+            sink.put_object(PROFILE_KEY.format(
+                self.run_date, self.run_name, 'txt'), summary)
+            self.logger.info('Stored profile of {} to {}'.format(
+                self.name, PROFILE_KEY.format(self.run_date, self.run_name, '*')))
+        except Exception as exception:
+            # A profile must never fail the run it measured
+            self.logger.error('Could not store profile of {}: {}'.format(
+                self.name, type(exception).__name__))
+
+
+def profiled(name, argv=None, run_id=None):
+    # run_id tells apart concurrent runs of the same collector, like the Lambda request id
+    mode, output = get_profile_options(argv)
+    return Profiler(name, mode=mode, output=output, run_id=run_id)
@@ -0,0 +1,215 @@
+import os
+import json
+import uuid
+import logging
+from collections import deque
+
+import boto3
+
+
+class LocalQueue(object):
+    # In-process stand-in for SQS, handy for local runs
+    def __init__(self):
+        self.messages = deque()
+
+    def send(self, body):
+        self.messages.append(json.dumps(body))
+
+    def receive(self, max_messages=1):
+        result = []
+        while self.messages and len(result) < max_messages:
+            result.append((None, json.loads(self.messages.popleft())))
+        return result
+
+    def delete(self, receipt):
+        pass
+
+
+class FileQueue(object):
+    # One file per message; received messages are renamed until deleted
+    def __init__(self, queue_dir):
+        self.queue_dir = queue_dir
+        os.makedirs(queue_dir, exist_ok=True)
+
+    def send(self, body):
+        path = os.path.join(self.queue_dir, uuid.uuid4().hex + '.json')
+        with open(path + '.tmp', 'w') as w:
+            json.dump(body, w)
+        os.replace(path + '.tmp', path)
+
+    def receive(self, max_messages=1):
+        result = []
+        for name in sorted(os.listdir(self.queue_dir)):
+            if len(result) == max_messages:
+                break
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.queue_dir, name)
+            receipt = path + '.inflight'
+            try:
+                os.rename(path, receipt)
+            except FileNotFoundError:
+                # Another worker got this message first
+                continue
+            with open(receipt) as r:
+                result.append((receipt, json.load(r)))
+        return result
+
+    def delete(self, receipt):
+        os.remove(receipt)
+
+
+class SQSQueue(object):
+    def __init__(self, queue_url):
+        self.queue_url = queue_url
+        self.sqs = boto3.client('sqs')
+
+    def send(self, body):
+        self.sqs.send_message(QueueUrl=self.queue_url,
+                              MessageBody=json.dumps(body))
+
+    def receive(self, max_messages=1):
+        resp = self.sqs.receive_message(QueueUrl=self.queue_url,
+                                        MaxNumberOfMessages=min(
+                                            max_messages, 10),
+                                        WaitTimeSeconds=1)
+        return [(m['ReceiptHandle'], json.loads(m['Body'])) for m in resp.get('Messages', [])]
+
+    def delete(self, receipt):
+        self.sqs.delete_message(QueueUrl=self.queue_url,
+                                ReceiptHandle=receipt)
+
+
+class ShardPlanner(object):
+    def __init__(self, queue, state_store, prefix, num_shards=8, max_attempts=3):
+        self.logger = logging.getLogger(
+            'daily_collector.{}'.format(self.__class__.__name__))
+        self.queue = queue
+        self.state_store = state_store
+        self.prefix = prefix
+        self.num_shards = num_shards
+        self.max_attempts = max_attempts
+
+    def get_manifest_key(self):
+        return '{}/manifest.json'.format(self.prefix)
+
+    def get_status_key(self, run_id, shard_id):
+        return '{}/{}/{}.json'.format(self.prefix, run_id, shard_id)
+
+    def split(self, links):
+        sorted_links = sorted(links)
+        num_shards = max(1, min(self.num_shards, len(sorted_links)))
+        size, remainder = divmod(len(sorted_links), num_shards)
+        shards = []
+        start = 0
+        for shard_id in range(num_shards):
+            end = start + size + (1 if shard_id < remainder else 0)
+            shards.append(sorted_links[start:end])
+            start = end
+        return shards
+
+    def plan(self, links, run_id, carried=None):
+        # Links carried over from unfinished shards of the last run keep a shard of their own,
+        # so a bad shard never slows the rest down
+        carried = carried or []
+        carried_links = set(link for one in carried for link in one['links'])
+        shards = [one['links'] for one in carried] + \
+            self.split([link for link in links if link not in carried_links])
+        manifest = {
+            'run_id': run_id,
+            'shards': {str(i): shard for i, shard in enumerate(shards)},
+            'carries': {str(i): one['carries'] for i, one in enumerate(carried)},
+            'merged': []
+        }
+        self.state_store.save(self.get_manifest_key(), manifest)
+        for shard_id, shard_links in manifest['shards'].items():
+            self.send(run_id, shard_id, shard_links, attempt=1)
+        self.logger.info('Planned run {} with {} shards of {} links, {} carried over'.format(
+            run_id, len(shards), len(links), len(carried)))
+        return manifest
+
+    def send(self, run_id, shard_id, links, attempt):
+        self.queue.send({
+            'run_id': run_id,
+            'shard_id': shard_id,
+            'links': links,
+            'attempt': attempt
+        })
+
+    def load_manifest(self):
+        return self.state_store.load(self.get_manifest_key())
+
+    def get_status(self, run_id, shard_id):
+        return self.state_store.load(self.get_status_key(run_id, shard_id))
+
+    def mark_done(self, message, result):
+        self.state_store.save(self.get_status_key(message['run_id'], message['shard_id']), {
+            'status': 'done',
+            'attempt': message['attempt'],
+            'result': result
+        })
+        self.logger.info('Shard {} of run {} done'.format(
+            message['shard_id'], message['run_id']))
+
+    def mark_failed(self, message, error):
+        self.state_store.save(self.get_status_key(message['run_id'], message['shard_id']), {
+            'status': 'failed',
+            'attempt': message['attempt'],
+            'error': error
+        })
+        if message['attempt'] < self.max_attempts:
+            self.logger.warn('Shard {} of run {} failed on attempt {}, re-queueing ...'.format(
+                message['shard_id'], message['run_id'], message['attempt']))
+            self.send(message['run_id'], message['shard_id'],
+                      message['links'], message['attempt'] + 1)
+        else:
+            self.logger.error('Shard {} of run {} failed {} times, giving up for this run'.format(
+                message['shard_id'], message['run_id'], message['attempt']))
+
+    def collect(self, manifest):
+        # Returns results of shards finished since the last collect, and ids of the unfinished ones
+        results = []
+        unfinished = []
+        for shard_id in sorted(manifest['shards'], key=int):
+            if shard_id in manifest['merged']:
+                continue
+            status = self.get_status(manifest['run_id'], shard_id)
+            if status and status['status'] == 'done':
+                results.append(status['result'])
+                manifest['merged'].append(shard_id)
+            else:
+                unfinished.append(shard_id)
+        return results, unfinished
+
+    def save_manifest(self, manifest):
+        self.state_store.save(self.get_manifest_key(), manifest)
+
+    def carry_over(self, manifest, shard_ids):
+        # Unfinished shards are carried into the next run, for at most max_attempts runs in all;
+        # after that their links are split among the other shards again
+        carried = []
+        for shard_id in shard_ids:
+            carries = manifest.get('carries', {}).get(shard_id, 0) + 1
+            if carries >= self.max_attempts:
+                self.logger.error('Shard {} of run {} unfinished in {} runs, no longer keeping it apart'.format(
+                    shard_id, manifest['run_id'], carries))
+                continue
+            self.logger.warn('Carrying unfinished shard {} of run {} over to the next run'.format(
+                shard_id, manifest['run_id']))
+            carried.append({
+                'links': manifest['shards'][shard_id],
+                'carries': carries
+            })
+        return carried
+
+    def drain(self, handler, max_messages=10):
+        # Pull shards from the queue until it is empty, for queues without a push trigger
+        handled = 0
+        while True:
+            messages = self.queue.receive(max_messages)
+            if not messages:
+                return handled
+            for receipt, message in messages:
+                handler(message)
+                self.queue.delete(receipt)
+                handled += 1
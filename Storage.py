@@ -0,0 +1,203 @@
+import os
+import queue
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import boto3
+import sqlalchemy as sa
+from sqlalchemy.pool import StaticPool
+
+from Database import Database, get_month_day
+
+
+def log_store_result(logger, prefix, rows, counts):
+    # counts is None when the rows were only queued by a WriteBehindQueue
+    if counts is None:
+        logger.info('{} Queued {:>5} rows for writing'.format(prefix, len(rows)))
+        return
+    no_inserts, no_updates, no_notouch = counts
+    logger.info('{} Total from json:{:>5} Inserted: {:>5} Updated: {:>5} Up-to-date: {:>5}'.format(
+        prefix,
+        len(rows),
+        no_inserts,
+        no_updates,
+        no_notouch
+    ))
+
+
+class S3Sink(object):
+    def __init__(self, bucket_name):
+        # Clients are thread safe while resources are not
+        self.s3 = boto3.client('s3')
+        self.bucket_name = bucket_name
+
+    def put_object(self, key, body, **extra):
+        self.s3.put_object(Bucket=self.bucket_name,
+                           Key=key, Body=body, **extra)
+
+
+class LocalFileSink(object):
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+
+    def put_object(self, key, body, **extra):
+        path = os.path.join(self.root_dir, *key.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as w:
+            w.write(body.encode('utf-8') if isinstance(body, str) else body)
+
+
+class SQLiteSink(Database):
+    # Same schema and upsert logic as RDS, in a local file
+    def __init__(self, path):
+        super(SQLiteSink, self).__init__(database_url='sqlite:///' + path)
+        # Collectors pass timestamps as strings, which the SQLite DateTime type refuses
+        self.event_table = sa.table('event', *[sa.column(c.name, sa.Text if c.name == 'timestamp' else c.type)
+                                               for c in self.event_table.columns])
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS label (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT)')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS event (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TIMESTAMP,
+            title TEXT,
+            text TEXT,
+            link TEXT,
+            label_id INTEGER REFERENCES label (id),
+            image_link TEXT,
+            media_link TEXT,
+            month_day TEXT,
+            year INTEGER)''')
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS event_month_day_label_id_idx ON event (month_day, label_id)')
+
+    def get_db_conn(self):
+        # WriteBehindQueue writes from its worker threads, and already serializes them with row_lock
+        engine = sa.create_engine(self.database_url, echo=False,
+                                  connect_args={'check_same_thread': False},
+                                  poolclass=StaticPool)
+        return engine.connect()
+
+
+class RecordingSink(object):
+    # Passes rows on to storage and remembers them, for the day bundles and the columnar export
+    def __init__(self, storage):
+        self.storage = storage
+        self.touched_days = set()
+        self.rows = []
+
+    def get_label_id_from_name(self, name):
+        return self.storage.get_label_id_from_name(name)
+
+    def store_rds(self, event_rows, label_id, already_same):
+        self.touched_days.update(row.get('month_day') or get_month_day(
+            row['timestamp']) for row in event_rows)
+        self.rows.extend(event_rows)
+        return self.storage.store_rds(event_rows, label_id, already_same)
+
+
+class WriteBehindQueue(object):
+    def __init__(self, object_sink, row_sink, max_pending=1000, batch_size=100, workers=4, linger=1.0):
+        self.logger = logging.getLogger(
+            'daily_collector.{}'.format(self.__class__.__name__))
+        self.object_sink = object_sink
+        self.row_sink = row_sink
+        self.batch_size = batch_size
+        # Seconds a partial batch of rows waits for more rows before being written anyway
+        self.linger = linger
+        # Backpressure: producers block once max_pending items wait, or every worker is busy
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.in_flight = threading.BoundedSemaphore(workers * 2)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # The database connection is shared, so row batches are written one at a time
+        self.row_lock = threading.Lock()
+        self.futures = []
+        self.errors = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put_object(self, key, body, **extra):
+        self.pending.put(('object', (key, body, extra)))
+
+    def get_label_id_from_name(self, name):
+        with self.row_lock:
+            return self.row_sink.get_label_id_from_name(name)
+
+    def store_rds(self, event_rows, label_id, already_same):
+        for row in event_rows:
+            self.pending.put(('row', (label_id, already_same, row)))
+        return None
+
+    def run(self):
+        batches = {}
+        while True:
+            try:
+                kind, item = self.pending.get(timeout=self.linger)
+            except queue.Empty:
+                self.submit_batches(batches)
+                continue
+            if kind == 'object':
+                self.submit(self.write_object, *item)
+            elif kind == 'row':
+                label_id, already_same, row = item
+                batch = batches.setdefault((label_id, already_same), [])
+                batch.append(row)
+                if len(batch) >= self.batch_size:
+                    self.submit(self.write_rows, label_id,
+                                already_same, batches.pop((label_id, already_same)))
+            else:
+                # 'flush' and 'stop' both write out whatever is batched and signal the caller
+                self.submit_batches(batches)
+                item.set()
+            self.pending.task_done()
+            if kind == 'stop':
+                return
+
+    def submit_batches(self, batches):
+        for (label_id, already_same), rows in list(batches.items()):
+            self.submit(self.write_rows, label_id, already_same, rows)
+        batches.clear()
+
+    def submit(self, fn, *args):
+        self.in_flight.acquire()
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(lambda f: self.in_flight.release())
+        self.futures.append(future)
+
+    def write_object(self, key, body, extra):
+        try:
+            self.object_sink.put_object(key, body, **extra)
+            self.logger.info('Stored {}'.format(key))
+        except Exception as exception:
+            self.logger.error('Could not store {}: {}'.format(
+                key, type(exception).__name__))
+            self.errors.append(exception)
+
+    def write_rows(self, label_id, already_same, rows):
+        try:
+            with self.row_lock:
+                counts = self.row_sink.store_rds(rows, label_id, already_same)
+            log_store_result(self.logger, 'Label {}'.format(label_id), rows, counts)
+        except Exception as exception:
+            self.logger.error('Could not write {} rows of label {}: {}'.format(
+                len(rows), label_id, type(exception).__name__))
+            self.errors.append(exception)
+
+    def flush(self, kind='flush'):
+        # Blocks until everything queued so far is written, then raises the first failure if any
+        done = threading.Event()
+        self.pending.put((kind, done))
+        done.wait()
+        futures, self.futures = self.futures, []
+        wait(futures)
+        if self.errors:
+            errors, self.errors = self.errors, []
+            self.logger.error('{} writes failed'.format(len(errors)))
+            raise errors[0]
+
+    def close(self):
+        try:
+            self.flush(kind='stop')
+        finally:
+            self.thread.join()
+            self.executor.shutdown()
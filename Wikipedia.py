@@ -5,19 +5,50 @@ import random
 import logging
 
 from datetime import date, datetime
+from urllib.parse import unquote
 
 import stopit
+import requests
 from wikipedia import page, PageError, DisambiguationError
-from requests_html import HTMLSession
+from requests_html import HTMLSession, HTML
+
+from Checkpoint import Checkpoint
+from JsonStore import MemoryJsonStore
+from HttpCache import HttpCache
+from Storage import log_store_result
+from Database import get_month_day, get_year
+from Profiling import profiled
 
 
 WIKI_ENTRY = 'https://en.wikipedia.org/wiki/List_of_historical_anniversaries'
+WIKI_API = 'https://en.wikipedia.org/w/api.php'
+# The MediaWiki API accepts at most 50 titles per query
+REVISION_BATCH_SIZE = 50
+REVISIONS_KEY = 'Wikipedia-revisions/latest.json'
 SPLIT_HYPHEN = '-|–|－'
 EVENTS_INDEX = 1
 BIRTHS_INDEX = 2
 IMAGE_YEAR_CUTOFF = '1990'
 
 
+def get_date_without_year(one_date_wiki_url):
+    # Adding 2020 is a workaround for strptime default to 1900, which is not a leap year
+    obj_date = datetime.strptime(
+        '2020_'+one_date_wiki_url.split('/').pop(), '%Y_%B_%d')
+    return '{}-{}'.format(obj_date.month, obj_date.day)
+
+
+def get_page_title(one_date_wiki_url):
+    return unquote(one_date_wiki_url.split('/').pop()).replace('_', ' ')
+
+
+def get_date_links(http_cache=None):
+    # The index of day pages hardly ever changes, so it is revalidated rather than downloaded
+    r = (http_cache or HttpCache()).get(WIKI_ENTRY)
+    nav = HTML(html=r.text, url=WIKI_ENTRY).find('.navbox-list')
+    return set.union(*map(lambda one_month: one_month.absolute_links, nav))
+
+
 class WikiEvent(object):
     def __init__(self, event, date_without_year, suffix=''):
         self.logger = logging.getLogger(
@@ -98,16 +129,21 @@ class WikiEvent(object):
 
 
 class OneWikiDay(object):
-    def __init__(self, one_date_wiki_url, cached_result):
+    def __init__(self, one_date_wiki_url, cached_result, validators=None, checkpoint=None):
         self.logger = logging.getLogger(
             'daily_collector.{}'.format(self.__class__.__name__))
 
-        # Adding 2020 is a workaround for strptime default to 1900, which is not a leap year
-        obj_date = datetime.strptime(
-            '2020_'+one_date_wiki_url.split('/').pop(), '%Y_%B_%d')
-        self.date_without_year = '{}-{}'.format(obj_date.month, obj_date.day)
+        self.date_without_year = get_date_without_year(one_date_wiki_url)
+        # Events already enriched by an interrupted run, keyed by event string
+        self.checkpoint = checkpoint
+        self.enriched = checkpoint.section('enriched').setdefault(
+            self.date_without_year, {}) if checkpoint else {}
         self.cache_date = self.get_cache_date(
             cached_result[self.date_without_year])
+        # ETag and Last-Modified of the previous fetch, used for conditional requests
+        validators = validators or {}
+        self.etag = validators.get('etag')
+        self.last_modified = validators.get('last_modified')
         self.data = self.get_one_date(one_date_wiki_url)
         self.logger.info('Populated {:5>} entries for {:5>}'.format(
             len(self.data), self.date_without_year))
@@ -118,10 +154,25 @@ class OneWikiDay(object):
     def get_cache_date(self, dic_list):
         return set(['_'.join([e['date'], e['title']]) for e in dic_list])
 
+    def get_conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
     def get_one_date(self, one_date_wiki_url):
         result = []
         session = HTMLSession()
-        r = session.get(one_date_wiki_url)
+        r = session.get(one_date_wiki_url,
+                        headers=self.get_conditional_headers())
+        if r.status_code == 304:
+            self.logger.info(
+                '{} not modified since last fetch'.format(self.date_without_year))
+            return result
+        self.etag = r.headers.get('ETag')
+        self.last_modified = r.headers.get('Last-Modified')
         all_uls = r.html.find('ul')
         if '2 Events' in all_uls[0].text:
             # This is a workaround for January 1: https://en.wikipedia.org/wiki/January_1
@@ -143,9 +194,16 @@ class OneWikiDay(object):
         for e in events_list:
             try:
                 d = WikiEvent(e, date_without_year, suffix)
-                if not self.already_cached(d):
-                    d.get_text_image_link()
-                    result.append(d.data)
+                if self.already_cached(d):
+                    continue
+                if d.get_string() in self.enriched:
+                    result.append(self.enriched[d.get_string()])
+                    continue
+                d.get_text_image_link()
+                result.append(d.data)
+                self.enriched[d.get_string()] = d.data
+                if self.checkpoint:
+                    self.checkpoint.maybe_save()
             except ValueError:
                 self.logger.debug('Exception when trying to parse {} {}'.format(
                     date_without_year, e.text))
@@ -153,27 +211,87 @@ class OneWikiDay(object):
 
 
 class Wikipedia(object):
-    def __init__(self, cached=None):
+    def __init__(self, cached=None, revisions=None, links=None, checkpoint=None):
         self.logger = logging.getLogger(
             'daily_collector.{}'.format(self.__class__.__name__))
         self.label_name = 'Wikipedia'
         self.target_date = date.today().strftime('%Y-%m-%d')
-        self.all_links = self.get_date_links()
+        # Due to the 300 seconds timeout limit on lambda, the planner hands each invocation a shard of the links
+        self.all_links = set(links) if links else self.get_date_links()
         self.cached = cached
+        # Last processed revision of each day page, keyed by date_without_year
+        self.revisions = dict(revisions) if revisions else {}
         self.data = {}
-        # Due to the 300 seconds timeout limit on lambda, not all dates are examined at once
-        sorted_links = sorted(self.all_links)
-        target_links = sorted_links[:len(sorted_links)//2] if datetime.now(
-        ).time().hour < 12 else sorted_links[len(sorted_links)//2:]
+        self.checkpoint = checkpoint or Checkpoint(
+            MemoryJsonStore(), self.label_name)
+        self.checkpoint.reset_if_stale(self.target_date)
+        done_days = self.checkpoint.section('days')
+        target_links = sorted(self.all_links)
+        latest_revisions = self.get_latest_revisions(target_links)
         for single_link in target_links:
+            date_without_year = get_date_without_year(single_link)
+            if date_without_year in done_days:
+                self.logger.info(
+                    '{} restored from checkpoint'.format(date_without_year))
+                self.data[date_without_year] = done_days[date_without_year]['data']
+                self.revisions[date_without_year] = done_days[date_without_year]['revision']
+                continue
+            known = self.revisions.get(date_without_year, {})
+            revid = latest_revisions.get(get_page_title(single_link))
+            if revid is not None and known.get('revid') == revid:
+                self.logger.info('Revision {} of {} already processed, skipping ...'.format(
+                    revid, date_without_year))
+                continue
             self.logger.info('About to process {} ...'.format(single_link))
             try:
-                w = OneWikiDay(single_link, cached)
+                w = OneWikiDay(single_link, cached, validators=known,
+                               checkpoint=self.checkpoint)
             except Exception as exception:
                 self.logger.error(
                     '*********** Skipped ********* {} {}'.format(type(exception).__name__, single_link))
                 continue
             self.data[w.date_without_year] = w.data
+            self.revisions[w.date_without_year] = {
+                'revid': revid,
+                'etag': w.etag,
+                'last_modified': w.last_modified
+            }
+            done_days[w.date_without_year] = {
+                'data': w.data,
+                'revision': self.revisions[w.date_without_year]
+            }
+            self.checkpoint.section('enriched').pop(w.date_without_year, None)
+            self.checkpoint.maybe_save()
+        self.checkpoint.save()
+
+    def get_latest_revisions(self, links):
+        # Returns {page title: current revision id}, batching titles into as few API calls as possible
+        titles = sorted(get_page_title(link) for link in links)
+        result = {}
+        for start in range(0, len(titles), REVISION_BATCH_SIZE):
+            payload = {
+                'action': 'query',
+                'prop': 'revisions',
+                'rvprop': 'ids',
+                'titles': '|'.join(titles[start:start + REVISION_BATCH_SIZE]),
+                'format': 'json',
+                'formatversion': 2
+            }
+            try:
+                pages = requests.get(
+                    WIKI_API, params=payload).json()['query']['pages']
+            except Exception as exception:
+                # Without revision ids every page simply gets fetched as before
+                self.logger.warn('Could not get revisions: {} {}'.format(
+                    type(exception).__name__, payload['titles']))
+                continue
+            for one_page in pages:
+                if 'revisions' in one_page:
+                    result[one_page['title']
+                           ] = one_page['revisions'][0]['revid']
+        self.logger.info(
+            'Got current revisions of {} pages'.format(len(result)))
+        return result
 
     def store_json(self):
         # Only for development
@@ -182,10 +300,7 @@ class Wikipedia(object):
             json.dump(result, w, indent=2)
 
     def get_date_links(self):
-        session = HTMLSession()
-        r = session.get(WIKI_ENTRY)
-        nav = r.html.find('.navbox-list')
-        return set.union(*map(lambda one_month: one_month.absolute_links, nav))
+        return get_date_links()
 
     def already_same(self, existing_event, row):
         return existing_event['image_link'] == row['image_link'] \
@@ -204,7 +319,9 @@ class Wikipedia(object):
                     'link': '',
                     'label_id': label_id,
                     'image_link':  jsevt['image_link'] if 'image_link' in jsevt else '',
-                    'media_link':  jsevt['media_link'] if 'media_link' in jsevt else ''
+                    'media_link':  jsevt['media_link'] if 'media_link' in jsevt else '',
+                    'month_day': get_month_day(jsevt['date']),
+                    'year': get_year(jsevt['date'])
                 })
             except AssertionError:
                 self.logger.error('This event is not in good shape :(')
@@ -220,11 +337,11 @@ class Wikipedia(object):
             self.cached[key].extend(self.data[key])
         return self.cached
 
-    def store_s3(self, s3_bucket):
+    def store_s3(self, storage):
         if len(self.data.keys()) > 0:
             all_events = self.merge_cache_and_diff()
-            s3_bucket.Object(key='{}/{}.json'.format(self.label_name,
-                                                     self.target_date)).put(Body=json.dumps(all_events, indent=2))
+            storage.put_object('{}/{}.json'.format(self.label_name,
+                                                   self.target_date), json.dumps(all_events, indent=2))
             self.logger.info('Successfully stored {} {} events into S3'.format(
                 self.target_date, sum([len(self.data[day]) for day in self.data])))
         else:
@@ -232,23 +349,19 @@ class Wikipedia(object):
                 '***** No data for {} so skipping... '.format(self.target_date))
 
     def store_rds(self, db):
-        events_list = [e for d in self.data for e in self.data[d]]
         label_id = db.get_label_id_from_name(self.label_name)
-        rows = self.map_json_array_to_rows(events_list, label_id)
-        no_inserts, no_updates, no_notouch = db.store_rds(
-            rows, label_id, self.already_same)
-        self.logger.info('Total from json:{:>5} Inserted: {:>5} Updated: {:>5} Up-to-date: {:>5}'.format(
-            len(rows),
-            no_inserts,
-            no_updates,
-            no_notouch
-        ))
+        # Rows are upserted, so a run resumed from the checkpoint can safely store them again
+        for day in sorted(self.data):
+            rows = self.map_json_array_to_rows(self.data[day], label_id)
+            counts = db.store_rds(rows, label_id, self.already_same)
+            log_store_result(self.logger, day, rows, counts)
 
 
 def main():
     with open('2018-06-21.json') as b21:
         cached = json.load(b21)
-    w = Wikipedia(cached=cached)
+    with profiled('Wikipedia'):
+        w = Wikipedia(cached=cached)
 
 
 if __name__ == '__main__':
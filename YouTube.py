@@ -0,0 +1,99 @@
+import os
+import logging
+import threading
+from datetime import datetime, timedelta
+
+import requests
+
+from JsonStore import MemoryJsonStore
+
+YOUTUBE_API = 'https://www.googleapis.com/youtube/v3/search'
+YOUTUBE_LINK_PREFIX = 'https://www.youtube.com/watch?v='
+YOUTUBE_SEARCH_PREFIX = 'https://www.youtube.com/results?search_query='
+# Only the parts of the response that the filters and the links below use
+YOUTUBE_FIELDS = 'items(id(kind,videoId),snippet(title,thumbnails(default(url),high(url))))'
+# A search.list call costs 100 units of the default 10000 units per day
+SEARCH_COST = 100
+DAILY_QUOTA = 10000
+QUOTA_KEY = 'YouTube-quota/{}.json'
+
+
+def is_video(item):
+    return item['id']['kind'] == 'youtube#video'
+
+
+def is_trailer(item):
+    return is_video(item) and 'Trailer' in item['snippet']['title']
+
+
+class YouTube(object):
+    def __init__(self, state_store=None, daily_quota=DAILY_QUOTA, reserve=0):
+        self.logger = logging.getLogger(
+            'daily_collector.{}'.format(self.__class__.__name__))
+        self.state_store = state_store or MemoryJsonStore()
+        self.daily_quota = daily_quota
+        # Units kept aside for other users of the same API key
+        self.reserve = reserve
+        self.lock = threading.Lock()
+        # Search results per query, shared by every collector within a run
+        self.search_memo = {}
+        self.quota_key = QUOTA_KEY.format(self.get_quota_date())
+        self.used = self.state_store.load(
+            self.quota_key, default={}).get('used', 0)
+
+    def get_quota_date(self):
+        # The quota resets at midnight Pacific Time
+        return (datetime.utcnow() - timedelta(hours=8)).strftime('%Y-%m-%d')
+
+    def has_budget(self):
+        return self.used + SEARCH_COST <= self.daily_quota - self.reserve
+
+    def charge(self, units):
+        self.used += units
+        self.state_store.save(self.quota_key, {'used': self.used})
+
+    def search(self, query):
+        with self.lock:
+            if query in self.search_memo:
+                return self.search_memo[query]
+            if not self.has_budget():
+                self.logger.warn(
+                    'YouTube quota almost used up ({} units), skipping {}'.format(self.used, query))
+                return None
+            payload = {
+                'q': query,
+                'maxResults': 5,
+                'type': 'video',
+                'fields': YOUTUBE_FIELDS,
+                'key': os.environ['YOUTUBE_API_KEY'],
+                'part': 'snippet'
+            }
+            response = requests.get(YOUTUBE_API, params=payload).json()
+            self.charge(SEARCH_COST)
+            if 'error' in response:
+                reasons = [e.get('reason')
+                           for e in response['error'].get('errors', [])]
+                self.logger.error(
+                    'YouTube search failed for {}: {}'.format(query, reasons))
+                if 'quotaExceeded' in reasons or 'dailyLimitExceeded' in reasons:
+                    self.charge(self.daily_quota)
+                return None
+            self.search_memo[query] = response.get('items', [])
+            return self.search_memo[query]
+
+    def lookup(self, query, match=is_video, thumbnail='default'):
+        # Returns (image_link, media_link), both empty when nothing matches,
+        # and both None when the search could not run, so links stored by earlier runs are kept
+        items = self.search(query)
+        if items is None:
+            return None, None
+        if not items:
+            return '', ''
+        videos = list(filter(match, items))
+        if len(videos) > 0:
+            winner = videos[0]
+            image_link = winner['snippet']['thumbnails'].get(
+                thumbnail, {}).get('url', '')
+            media_link = YOUTUBE_LINK_PREFIX + winner['id']['videoId']
+            return image_link, media_link
+        return '', ''
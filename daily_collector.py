@@ -2,15 +2,23 @@ import os
 import sys
 import json
 import logging
-from datetime import timedelta, date
+from datetime import timedelta, date, datetime
 
 import boto3
 
 from Database import Database
+from JsonStore import S3JsonStore, LocalJsonStore
+from Checkpoint import Checkpoint
+from Sharding import ShardPlanner, LocalQueue, FileQueue, SQSQueue
+from Storage import S3Sink, LocalFileSink, SQLiteSink, WriteBehindQueue, RecordingSink
 from NYT import NYT
 from Billboard import Billboard
-from Wikipedia import Wikipedia
+from Wikipedia import Wikipedia, REVISIONS_KEY, get_date_links
 from Movies import Movies
+from YouTube import YouTube
+from DayBundles import DayBundles
+from Profiling import profiled, stage
+from HttpCache import HttpCache
 
 h = logging.StreamHandler(sys.stdout)
 h.setFormatter(logging.Formatter(
@@ -23,8 +31,35 @@ logger.setLevel(logging.INFO)
 
 s3 = boto3.client('s3')
 bucket_name = os.environ['BUCKET_NAME']
-s3_bucket = boto3.resource("s3").Bucket(bucket_name)
-db = Database()
+state_store = S3JsonStore(bucket_name)
+# Checkpoints go to the bucket unless a local directory is given
+checkpoint_store = LocalJsonStore(os.environ['CHECKPOINT_DIR']) if os.environ.get(
+    'CHECKPOINT_DIR') else state_store
+# Objects and rows go to S3 and RDS unless a local directory is given
+local_storage_dir = os.environ.get('LOCAL_STORAGE_DIR')
+if local_storage_dir:
+    object_sink = LocalFileSink(local_storage_dir)
+    db = SQLiteSink(os.path.join(local_storage_dir, 'dejaview.sqlite'))
+else:
+    object_sink = S3Sink(bucket_name)
+    db = Database()
+
+# Columnar export of stored rows, a local directory or s3://bucket/prefix
+# pyarrow is only imported when the export is turned on
+if os.environ.get('EXPORT_ROOT'):
+    from Export import Exporter
+    exporter = Exporter(os.environ['EXPORT_ROOT'])
+else:
+    exporter = None
+
+# Conditional HTTP cache for chart pages and the Wikipedia index, in the bucket unless a local directory is given
+http_cache = HttpCache(LocalJsonStore(os.environ['HTTP_CACHE_DIR']) if os.environ.get(
+    'HTTP_CACHE_DIR') else state_store)
+
+
+def get_storage():
+    # Writes happen in the background while the collectors keep fetching
+    return WriteBehindQueue(object_sink, db)
 
 
 def get_matching_s3_objects(bucket_name, prefix='', suffix=''):
@@ -47,39 +82,75 @@ def get_matching_s3_objects(bucket_name, prefix='', suffix=''):
             break
 
 
-def collect_nyt(s3_bucket, db):
+def export_rows(label_name, recorder):
+    # The rows are already stored, so a failed export is logged rather than failing the run
+    if not exporter:
+        return
+    try:
+        exporter.append(label_name, recorder.rows)
+    except Exception as exception:
+        logger.error('Could not export {} rows: {}'.format(
+            label_name, type(exception).__name__))
+
+
+def compact_exports(label_names):
+    if exporter:
+        exporter.compact(label_names)
+
+
+def collect_nyt(storage):
     logger.info('Collecting NYT articles...')
-    nyt = NYT()
-    nyt.store_s3(s3_bucket)
-    nyt.store_rds(db)
+    checkpoint = Checkpoint(checkpoint_store, 'Checkpoints/New-York-Times.json')
+    nyt = NYT(checkpoint=checkpoint)
+    stage('NYT fetched')
+    recorder = RecordingSink(storage)
+    nyt.store_s3(storage)
+    nyt.store_rds(recorder)
+    storage.flush()
+    stage('NYT stored')
+    checkpoint.clear()
+    export_rows(nyt.label_name, recorder)
     logger.info('{} NYT events handled successfully'.format(len(nyt.events)))
+    return recorder.touched_days
 
 
-def collect_billboard(s3_bucket, db):
+def collect_billboard(storage, youtube):
     logger.info('Collecting Billboard events...')
-    billboard = Billboard()
-    billboard.store_s3(s3_bucket)
-    billboard.store_rds(db)
+    chart_names = os.environ.get('BILLBOARD_CHARTS', 'hot-100').split(',')
+    billboard = Billboard(chart_names=chart_names, youtube=youtube,
+                          chart_store=state_store)
+    stage('Billboard fetched')
+    recorder = RecordingSink(storage)
+    billboard.store_s3(storage)
+    billboard.store_rds(recorder)
+    stage('Billboard stored')
+    export_rows(billboard.label_name, recorder)
     logger.info('{} Billboard events handled successfully'.format(
         len(billboard.events)))
+    return recorder.touched_days
 
 
-def collect_movies(s3_bucket, db):
+def collect_movies(storage, youtube):
     logger.info('Collecting Movies ...')
-    m = Movies()
+    m = Movies(youtube=youtube, http_cache=http_cache)
+    stage('Movies fetched')
+    recorder = RecordingSink(storage)
     if m.events:
-        m.store_rds(db)
-        m.store_s3(s3_bucket)
+        m.store_rds(recorder)
+        m.store_s3(storage)
+        stage('Movies stored')
+        export_rows(m.label_name, recorder)
         logger.info(
             '{} Movies events handled successfully'.format(len(m.events)))
     else:
         logger.info('Nothing to do with this date for movies')
+    return recorder.touched_days
 
 
 def get_most_recent(label_name):
     bucket_name = os.environ['BUCKET_NAME']
     objs = list(get_matching_s3_objects(
-        bucket_name, prefix=label_name, suffix='json'))
+        bucket_name, prefix=label_name + '/', suffix='json'))
     assert len(objs) > 0
     most_recent_key = max(objs, key=lambda o: o['Key'])['Key']
     logger.info('Loading Wikipedia cache {} from S3 ...'.format(most_recent_key))
@@ -88,23 +159,143 @@ def get_most_recent(label_name):
     return json_obj
 
 
-def collect_wikipedia(s3_bucket, db):
+def get_wikipedia_planner():
+    if os.environ.get('WIKIPEDIA_QUEUE_URL'):
+        queue = SQSQueue(os.environ['WIKIPEDIA_QUEUE_URL'])
+    elif os.environ.get('WIKIPEDIA_QUEUE_DIR'):
+        # Shards survive the process, and several local workers can drain the same directory
+        queue = FileQueue(os.environ['WIKIPEDIA_QUEUE_DIR'])
+    else:
+        queue = LocalQueue()
+    return ShardPlanner(queue, state_store, 'Wikipedia-shards',
+                        num_shards=int(os.environ.get('WIKIPEDIA_SHARDS', 8)))
+
+
+def collect_wikipedia_shard(message, storage, planner):
+    logger.info('Collecting shard {} of run {} ({} Wikipedia pages) ...'.format(
+        message['shard_id'], message['run_id'], len(message['links'])))
+    checkpoint = Checkpoint(checkpoint_store, 'Checkpoints/Wikipedia-{}-{}.json'.format(
+        message['run_id'], message['shard_id']))
+    recorder = RecordingSink(storage)
+    try:
+        cached = get_most_recent('Wikipedia')
+        revisions = state_store.load(REVISIONS_KEY, default={})
+        w = Wikipedia(cached=cached, revisions=revisions,
+                      links=message['links'], checkpoint=checkpoint)
+        stage('Wikipedia shard {} fetched'.format(message['shard_id']))
+        w.store_rds(recorder)
+        storage.flush()
+        stage('Wikipedia shard {} stored'.format(message['shard_id']))
+    except Exception as exception:
+        logger.error('Shard {} failed: {}'.format(
+            message['shard_id'], type(exception).__name__))
+        planner.mark_failed(message, type(exception).__name__)
+        return
+    # The cache and the revisions are merged by the planner, so concurrent shards never overwrite each other
+    planner.mark_done(message, {
+        'data': w.data,
+        'revisions': {day: w.revisions[day] for day in w.data}
+    })
+    checkpoint.clear()
+    # Only after mark_done, so a failed export or render never re-queues the shard
+    export_rows(w.label_name, recorder)
+    render_day_bundles(recorder.touched_days)
+
+
+def render_day_bundles(month_days):
+    # Rows must be flushed before this, the bundles are read back from the database
+    if not month_days:
+        return
+    try:
+        DayBundles(db, object_sink, state_store).render_days(month_days)
+    except Exception as exception:
+        # The rows are already stored, the next run that touches these days renders them again
+        logger.error('Could not render {} day bundles: {}'.format(
+            len(month_days), type(exception).__name__))
+
+
+def merge_wikipedia_shards(results):
+    if not results:
+        return
     cached = get_most_recent('Wikipedia')
-    logger.info('Loading currenet Wikipedia on this day pages ...')
-    w = Wikipedia(cached=cached)
-    w.store_rds(db)
-    w.store_s3(s3_bucket)
+    revisions = state_store.load(REVISIONS_KEY, default={})
+    for result in results:
+        for day in result['data']:
+            cached[day].extend(result['data'][day])
+        revisions.update(result['revisions'])
+    target_date = date.today().strftime('%Y-%m-%d')
+    object_sink.put_object('Wikipedia/{}.json'.format(target_date),
+                           json.dumps(cached, indent=2))
+    # Only remember the revisions once their events are safely stored
+    state_store.save(REVISIONS_KEY, revisions)
+    logger.info('Merged {} Wikipedia shards into {}'.format(
+        len(results), target_date))
+    compact_exports(['Wikipedia'])
+
+
+def merge_finished_shards(planner):
+    # Returns the manifest of the last run and the ids of its shards that are not done yet
+    manifest = planner.load_manifest()
+    if not manifest:
+        return None, []
+    results, unfinished = planner.collect(manifest)
+    merge_wikipedia_shards(results)
+    planner.save_manifest(manifest)
+    return manifest, unfinished
+
+
+def plan_wikipedia_run(planner):
+    # A new run is planned every time, whatever is left of the last one goes into it
+    manifest, unfinished = merge_finished_shards(planner)
+    carried = planner.carry_over(manifest, unfinished) if manifest else []
+    planner.plan(get_date_links(http_cache),
+                 datetime.now().strftime('%Y%m%d%H%M%S'), carried=carried)
 
 
 def wikipedia_handler(event, context):
-    collect_wikipedia(s3_bucket, db)
+    with profiled('wikipedia_handler', run_id=getattr(context, 'aws_request_id', None)):
+        planner = get_wikipedia_planner()
+        plan_wikipedia_run(planner)
+
+
+def wikipedia_worker_handler(event, context):
+    with profiled('wikipedia_worker_handler', run_id=getattr(context, 'aws_request_id', None)):
+        planner = get_wikipedia_planner()
+        storage = get_storage()
+        try:
+            for record in event['Records']:
+                collect_wikipedia_shard(
+                    json.loads(record['body']), storage, planner)
+        finally:
+            storage.close()
 
 
 def lambda_handler(event, context):
-    collect_nyt(s3_bucket, db)
-    collect_movies(s3_bucket, db)
-    collect_billboard(s3_bucket, db)
+    with profiled('lambda_handler', run_id=getattr(context, 'aws_request_id', None)):
+        storage = get_storage()
+        try:
+            touched_days = collect_nyt(storage)
+            # One YouTube service for all collectors, so lookups and quota are shared
+            youtube = YouTube(state_store=state_store)
+            touched_days |= collect_movies(storage, youtube)
+            touched_days |= collect_billboard(storage, youtube)
+            storage.flush()
+            render_day_bundles(touched_days)
+            compact_exports(['New-York-Times', 'Movies', 'Billboard'])
+        finally:
+            storage.close()
 
 
 if __name__ == '__main__':
-    wikipedia_handler({}, None)
+    # Without WIKIPEDIA_QUEUE_URL the shards are queued in memory, or in WIKIPEDIA_QUEUE_DIR, and worked off in this process
+    with profiled('daily_collector'):
+        planner = get_wikipedia_planner()
+        plan_wikipedia_run(planner)
+        storage = get_storage()
+        try:
+            planner.drain(lambda message: collect_wikipedia_shard(
+                message, storage, planner))
+        finally:
+            storage.close()
+        stage('Wikipedia shards done')
+        merge_finished_shards(planner)
@@ -0,0 +1,40 @@
+import os
+import tempfile
+from datetime import date
+
+from Billboard import Billboard, CHART_CACHE_KEY
+from JsonStore import MemoryJsonStore
+from Storage import SQLiteSink
+from YouTube import YouTube, YOUTUBE_LINK_PREFIX
+
+CHART_DATE = date(2018, 6, 23)
+CHART = {
+    'name': 'hot-100',
+    'date': '2018-06-23',
+    'entries': [{'title': 'Nice For What', 'artist': 'Drake', 'weeks': 9}]
+}
+
+
+def get_billboard(youtube):
+    chart_store = MemoryJsonStore()
+    chart_store.save(CHART_CACHE_KEY.format('hot-100', '2018-06-23'), CHART)
+    return Billboard(start_date=CHART_DATE, end_date=CHART_DATE,
+                     youtube=youtube, chart_store=chart_store)
+
+
+def test_links_survive_a_run_without_youtube_quota():
+    db = SQLiteSink(os.path.join(tempfile.mkdtemp(), 'dejaview.sqlite'))
+    enriched = YouTube()
+    enriched.search_memo['Nice+For+What+Drake'] = [{
+        'id': {'kind': 'youtube#video', 'videoId': 'U9BwWKXjVaI'},
+        'snippet': {'title': 'Nice For What', 'thumbnails': {'default': {'url': 'https://i.ytimg.com/1.jpg'}}}
+    }]
+    get_billboard(enriched).store_rds(db)
+
+    billboard = get_billboard(YouTube(daily_quota=0))
+    billboard.store_rds(db)
+
+    events = db.get_events_on_day('06-23')
+    assert len(events) == 1
+    assert events[0]['media_link'] == YOUTUBE_LINK_PREFIX + 'U9BwWKXjVaI'
+    assert events[0]['image_link'] == 'https://i.ytimg.com/1.jpg'
@@ -0,0 +1,52 @@
+from JsonStore import MemoryJsonStore
+from Sharding import ShardPlanner, LocalQueue
+
+LINKS = ['https://en.wikipedia.org/wiki/January_{}'.format(day)
+         for day in range(1, 11)]
+
+
+def get_planner(num_shards=3, max_attempts=3):
+    return ShardPlanner(LocalQueue(), MemoryJsonStore(), 'Wikipedia-shards',
+                        num_shards=num_shards, max_attempts=max_attempts)
+
+
+def test_split_covers_every_link_once_in_even_shards():
+    shards = get_planner().split(LINKS)
+    assert [len(shard) for shard in shards] == [4, 3, 3]
+    assert sorted(link for shard in shards for link in shard) == sorted(LINKS)
+    assert get_planner(num_shards=8).split(LINKS[:2]) == [
+        sorted(LINKS[:2])[:1], sorted(LINKS[:2])[1:]]
+
+
+def test_collect_returns_done_shards_once_and_the_unfinished_ones():
+    planner = get_planner()
+    manifest = planner.plan(LINKS, 'run1')
+
+    def handler(message):
+        if message['shard_id'] == '1':
+            planner.mark_failed(message, 'Boom')
+        else:
+            planner.mark_done(message, {'shard_id': message['shard_id']})
+    # Shard 1 fails on every attempt, and is re-queued until max_attempts
+    assert planner.drain(handler) == 5
+    results, unfinished = planner.collect(manifest)
+    assert [r['shard_id'] for r in results] == ['0', '2']
+    assert unfinished == ['1']
+    assert planner.collect(manifest) == ([], ['1'])
+
+
+def test_unfinished_shards_are_carried_over_until_max_attempts():
+    planner = get_planner()
+    manifest = planner.plan(LINKS, 'run1')
+    stuck, stuck_id = manifest['shards']['1'], '1'
+    for run_id in ['run2', 'run3']:
+        manifest = planner.plan(
+            LINKS, run_id, carried=planner.carry_over(manifest, [stuck_id]))
+        # The carried links keep a shard of their own, and no other shard has them
+        stuck_id = '0'
+        assert manifest['shards'][stuck_id] == stuck
+        assert sorted(link for shard in manifest['shards'].values()
+                      for link in shard) == sorted(LINKS)
+    # Unfinished in 3 runs, so its links go back among the other shards
+    assert planner.carry_over(manifest, [stuck_id]) == []
+    assert len(planner.plan(LINKS, 'run4')['shards']) == 3
@@ -0,0 +1,29 @@
+import os
+import tempfile
+
+from Storage import SQLiteSink, LocalFileSink, WriteBehindQueue
+
+
+def test_write_behind_queue_writes_rows_into_sqlite():
+    root_dir = tempfile.mkdtemp()
+    db = SQLiteSink(os.path.join(root_dir, 'dejaview.sqlite'))
+    storage = WriteBehindQueue(LocalFileSink(root_dir), db,
+                               batch_size=2, workers=2, linger=0.1)
+    label_id = storage.get_label_id_from_name('New-York-Times')
+    rows = [{
+        'timestamp': '2018-06-{}'.format(day),
+        'title': 'Title {}'.format(i),
+        'text': 'Text',
+        'link': 'https://example.com/{}'.format(i),
+        'label_id': label_id,
+        'image_link': '',
+        'media_link': ''
+    } for i, day in enumerate([20, 21, 21])]
+    storage.store_rds(rows, label_id, lambda existing_event, row: True)
+    storage.close()
+
+    assert [tuple(row) for row in db.get_events_on_day('06-20')] == [
+        ('New-York-Times', '2018-06-20', 'Title 0', 'Text',
+         'https://example.com/0', '', '')]
+    assert sorted(row['title'] for row in db.get_events_on_day('06-21')) == [
+        'Title 1', 'Title 2']